@@ -67,7 +67,21 @@ __model_list = [name for _, name, _ in pkgutil.iter_modules(path=['app/models'])
 DATABASE_CONFIG = {
     'timezone': 'Asia/Tokyo',
     'connections': {
-        'default': f'sqlite://{str(DATA_DIR / "database.sqlite")}',
+        'default': {
+            'engine': 'tortoise.backends.sqlite',
+            'credentials': {
+                'file_path': str(DATA_DIR / 'database.sqlite'),
+                # 以下は接続時に適用される SQLite の PRAGMA 設定
+                ## journal_mode=WAL にすることで、読み取りと書き込みを並行して行えるようになる
+                ## ほかは書き込み性能を向上させるための定番の設定
+                ## ref: https://www.sqlite.org/wal.html
+                'journal_mode': 'WAL',
+                'synchronous': 'NORMAL',
+                'temp_store': 'MEMORY',
+                # DB がロックされている場合に SQLite 側で最大5秒待つようにし、即座に "database is locked" エラーで失敗しないようにする
+                'busy_timeout': 5000,
+            },
+        },
     },
     'apps': {
         'models': {
@@ -1,6 +1,14 @@
 
+import asyncio
 import hashlib
 import typer
+
+# xxHash (xxh3-64) が利用可能であれば、MD5 の代わりに使う
+## SIMD 実装のため MD5 と比べて桁違いに速く、録画ファイルの同一性確認の用途には十分
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 from datetime import datetime
 from datetime import timedelta
 from pathlib import Path
@@ -50,7 +58,9 @@ class MetadataAnalyzer:
         # 録画ファイルを表すモデルを作成
         recorded_video = RecordedVideo()
         recorded_video.file_path = str(self.recorded_file_path)
-        recorded_video.file_size = self.recorded_file_path.stat().st_size
+        stat_result = self.recorded_file_path.stat()
+        recorded_video.file_size = stat_result.st_size
+        recorded_video.file_mtime = stat_result.st_mtime
 
         # 録画ファイルのハッシュを計算
         try:
@@ -250,11 +260,24 @@ class MetadataAnalyzer:
         if file_size < chunk_size * num_chunks:
             raise ValueError(f'File size must be at least {chunk_size * num_chunks} bytes.')
 
-        with self.recorded_file_path.open('rb') as file:
-
-            # SHA-256 だとハッシュ化に時間がかかるため、高速化のために MD5 を使用する
-            ## 録画ファイルのハッシュを取りたいだけなのでセキュリティの考慮は不要
-            hash_obj = hashlib.md5(usedforsecurity=False)
+        # 飛び飛びの数 MB を読むだけなので、Python 側のバッファリングを無効化して余計なコピーを発生させない
+        with self.recorded_file_path.open('rb', buffering=0) as file:
+
+            # xxHash (xxh3-64) が利用可能であればそちらを使う
+            ## 録画ファイルのハッシュを取りたいだけなのでセキュリティの考慮は不要で、同一性確認には xxh3 で十分
+            ## MD5 で計算された既存のハッシュと区別できるよう、バージョン付きのプレフィックスをつける
+            ## プレフィックスが異なる既存レコードはハッシュ不一致となり、次回スキャン時に一度だけ再解析される
+            if xxhash is not None:
+                hash_obj = xxhash.xxh3_64()
+                hash_prefix = 'xxh3:'
+            # xxHash がインストールされていない環境では従来通り MD5 を使用する
+            else:
+                hash_obj = hashlib.md5(usedforsecurity=False)
+                hash_prefix = ''
+
+            # チャンクごとの bytes オブジェクトの生成を避けるため、バッファを確保して使い回す
+            buffer = bytearray(chunk_size)
+            buffer_view = memoryview(buffer)
 
             # 指定された数のチャンクを読み込み、ハッシュを計算する
             for chunk_index in range(num_chunks):
@@ -263,12 +286,19 @@ class MetadataAnalyzer:
                 offset = (file_size // (num_chunks + 1)) * (chunk_index + 1)
                 file.seek(offset)
 
-                # チャンクを読み込み、ハッシュオブジェクトを更新する
-                chunk = file.read(chunk_size)
-                hash_obj.update(chunk)
+                # チャンクをバッファに読み込み、ハッシュオブジェクトを更新する
+                ## バッファリングなしの readinto() は要求サイズより少ないバイト数しか返さないことがあるため、
+                ## チャンクサイズ分を読み切るまで繰り返す (ハッシュ値が従来の実装と変わらないようにするため重要)
+                filled_size = 0
+                while filled_size < chunk_size:
+                    read_size = file.readinto(buffer_view[filled_size:])
+                    if read_size is None or read_size == 0:
+                        break
+                    filled_size += read_size
+                hash_obj.update(buffer_view[:filled_size])
 
         # ハッシュの16進数表現を返す
-        return hash_obj.hexdigest()
+        return hash_prefix + hash_obj.hexdigest()
 
 
     def __analyzeMediaInfo(self) -> MediaInfo | None:
@@ -359,6 +389,10 @@ if __name__ == '__main__':
         results = metadata_analyzer.analyze()
         if results:
             recorded_video, recorded_program, channel = results
+            # 解析処理では枝番なしの暫定チャンネル番号のみが設定されているため、ここで枝番を確定させる
+            if channel:
+                channel.channel_number = asyncio.run(channel.calculateChannelNumber())
+                channel.display_channel_id = channel.type.lower() + channel.channel_number
             recorded_program_dict = dict(recorded_program)
             recorded_program_dict['id'] = -1  # dummy
             recorded_program_dict['recorded_video_id'] = -1  # dummy
@@ -1,7 +1,6 @@
 
 import ariblib
 import ariblib.event
-import asyncio
 from ariblib.descriptors import AudioComponentDescriptor
 from ariblib.descriptors import ServiceDescriptor
 from ariblib.descriptors import TSInformationDescriptor
@@ -167,7 +166,10 @@ class TSInfoAnalyzer:
         channel.id = f'NID{channel.network_id}-SID{channel.service_id:03d}'
 
         # チャンネル番号を算出
-        channel.channel_number = asyncio.run(channel.calculateChannelNumber())
+        ## 地デジの枝番処理には DB アクセスが必要になるが、このメソッドはワーカースレッド上で実行されることがあり、
+        ## メインのイベントループに紐づいた共有 DB コネクションにはスレッド内から安全にアクセスできないため、
+        ## ここでは枝番なしの暫定チャンネル番号のみを算出し、枝番の確定は呼び出し側がイベントループ上で行う
+        channel.channel_number = channel.calculateProvisionalChannelNumber()
 
         # 表示用チャンネルID = チャンネルタイプ(小文字)+チャンネル番号
         channel.display_channel_id = channel.type.lower() + channel.channel_number
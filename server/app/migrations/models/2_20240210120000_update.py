@@ -0,0 +1,14 @@
+
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        ALTER TABLE "recorded_videos" ADD "file_mtime" REAL NOT NULL DEFAULT 0;
+    """
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        ALTER TABLE "recorded_videos" DROP COLUMN "file_mtime";
+    """
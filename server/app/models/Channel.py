@@ -480,15 +480,8 @@ class Channel(TortoiseModel):
         # 地デジ (録画番組向け): リモコン番号からチャンネル番号を算出する (枝番処理も行うが、DB アクセスが発生する)
         elif self.type == 'GR':
 
-            # 同じネットワーク内にあるサービスのカウントを取得
-            ## 地デジのサービス ID は、ARIB TR-B14 第五分冊 第七編 9.1 によると
-            ## (地域種別:6bit)(県複フラグ:1bit)(サービス種別:2bit)(地域事業者識別:4bit)(サービス番号:3bit) の 16bit で構成されている
-            ## 0x0007 はビット単位に直すと 0b0000000110000111 になるので、AND 演算でビットマスク（1以外のビットを強制的に0に設定）すると、
-            ## サービス番号 (0~7) のみを取得できる (1~8 に直すために +1 する)
-            same_network_id_count = (self.service_id & 0x0007) + 1
-
-            # 上2桁はリモコン番号から、下1桁は同じネットワーク内にあるサービスのカウント
-            channel_number = str(self.remocon_id).zfill(2) + str(same_network_id_count)
+            # 枝番を付与する前の暫定チャンネル番号を算出
+            channel_number = self.calculateProvisionalChannelNumber()
 
             # Tortoise ORM のコネクションが取得できない時は Tortoise ORM を初期化する
             ## 基本 MetadataAnalyzer を単独で実行したときくらいしか起きないはず…
@@ -530,6 +523,43 @@ class Channel(TortoiseModel):
         return channel_number
 
 
+    def calculateProvisionalChannelNumber(self) -> str:
+        """
+        DB アクセスなしで算出できる暫定のチャンネル番号を算出する
+        地デジで異なる NID-SID のサービスと同じチャンネル番号が衝突した場合の枝番は付与されないため、
+        確定したチャンネル番号が必要な場合は calculateChannelNumber() を使うこと
+        """
+
+        assert self.type is not None, 'type not set.'
+        assert self.service_id is not None, 'service_id not set.'
+
+        # 基本的にはサービス ID をチャンネル番号とする
+        channel_number = str(self.service_id).zfill(3)
+
+        # 地デジ: リモコン番号からチャンネル番号を算出する
+        if self.type == 'GR':
+            assert self.remocon_id is not None, 'remocon_id not set.'
+
+            # 同じネットワーク内にあるサービスのカウントを取得
+            ## 地デジのサービス ID は、ARIB TR-B14 第五分冊 第七編 9.1 によると
+            ## (地域種別:6bit)(県複フラグ:1bit)(サービス種別:2bit)(地域事業者識別:4bit)(サービス番号:3bit) の 16bit で構成されている
+            ## 0x0007 はビット単位に直すと 0b0000000110000111 になるので、AND 演算でビットマスク（1以外のビットを強制的に0に設定）すると、
+            ## サービス番号 (0~7) のみを取得できる (1~8 に直すために +1 する)
+            same_network_id_count = (self.service_id & 0x0007) + 1
+
+            # 上2桁はリモコン番号から、下1桁は同じネットワーク内にあるサービスのカウント
+            channel_number = str(self.remocon_id).zfill(2) + str(same_network_id_count)
+
+        # SKY: サービス ID を 1024 で割った余りをチャンネル番号とする
+        ## SPHD (network_id=10) のチャンネル番号は service_id - 32768 、
+        ## SPSD (SKYサービス系: network_id=3) のチャンネル番号は service_id - 16384 で求められる
+        ## 両者とも 1024 の倍数なので、1024 で割った余りからチャンネル番号が算出できる
+        elif self.type == 'SKY':
+            channel_number = str(self.service_id % 1024).zfill(3)
+
+        return channel_number
+
+
     def calculateIsSubchannel(self) -> bool:
         """ このチャンネルがサブチャンネルかどうかを算出する """
 
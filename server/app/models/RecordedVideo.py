@@ -4,32 +4,104 @@
 from __future__ import annotations
 
 import asyncio
-import concurrent.futures
 import gc
 import os
 import json
 import time
 import traceback
 from datetime import datetime
+from functools import partial
 from pathlib import Path
-from tortoise import connections
 from tortoise import exceptions
 from tortoise import fields
-from tortoise import Tortoise
 from tortoise import transactions
 from tortoise.fields import Field as TortoiseField
 from tortoise.models import Model as TortoiseModel
-from typing import cast, Literal
+from typing import Any, cast, Literal
 
 from app import logging
 from app.config import Config
-from app.config import LoadConfig
-from app.constants import DATABASE_CONFIG
 from app.models.Channel import Channel
 from app.models.RecordedProgram import RecordedProgram
 from app.schemas import CMSection
 
 
+# cm_sections の JSON エンコード/デコードには、利用可能であれば orjson を使う
+## orjson はネイティブ実装のため、float を多く含むリストでは標準の json より一桁速い
+try:
+    import orjson
+    def _EncodeJSON(value: Any) -> str:
+        return orjson.dumps(value).decode('utf-8')
+    _DecodeJSON = orjson.loads
+# orjson がインストールされていない環境では標準の json にフォールバックする
+except ImportError:
+    _EncodeJSON = partial(json.dumps, ensure_ascii=False)
+    _DecodeJSON = json.loads
+
+
+# スキャン対象の TS ファイルの拡張子 (ドットなし・小文字)
+_TS_FILE_EXTENSIONS = frozenset({'ts', 'm2t', 'm2ts', 'mts'})
+
+
+def _iter_ts_files(root: Path):
+    """
+    指定されたディレクトリ以下の TS ファイルのパスを再帰的に列挙するジェネレータ
+    os.walk() と異なり os.scandir() の返す DirEntry の d_type キャッシュを使うため、
+    エントリごとの余分な stat() システムコールが発生せず、ファイル数の多いディレクトリでも高速に走査できる
+
+    Args:
+        root (Path): 走査対象のディレクトリ
+
+    Yields:
+        str: 見つかった TS ファイルのフルパス
+    """
+
+    # 一度走査したディレクトリ・ファイルの (デバイス番号, inode 番号) の集合
+    ## ハードリンクやバインドマウントにより同一実体が複数のパスで見えている場合でも、
+    ## 同じ録画ファイルを重複してスキャン・解析してしまうことを防ぐ
+    seen_inodes: set[tuple[int, int]] = set()
+
+    # 再帰呼び出しの代わりにスタックで走査対象のディレクトリを管理する
+    stack: list[str] = [str(root)]
+    while stack:
+        current_dir = stack.pop()
+        try:
+            with os.scandir(current_dir) as scan_iterator:
+                for entry in scan_iterator:
+                    # シンボリックリンクにより同一ファイルが複数回スキャンされることを防ぐため、シンボリックリンクは辿らない
+                    if entry.is_dir(follow_symlinks=False):
+                        stat_result = entry.stat(follow_symlinks=False)
+                        inode_key = (stat_result.st_dev, stat_result.st_ino)
+                        if inode_key in seen_inodes:
+                            continue
+                        seen_inodes.add(inode_key)
+                        stack.append(entry.path)
+                        continue
+                    if entry.is_file() is False:
+                        continue
+                    # ._ から始まるファイルは Mac が勝手に作成するファイルなので無視する
+                    if entry.name.startswith('._'):
+                        continue
+                    # 当面 TS ファイルのみを対象とする
+                    ## Path.suffix と同じ判定になるよう、拡張子のないファイルや . から始まるだけのファイル名は除外する
+                    stem, dot, extension = entry.name.rpartition('.')
+                    if dot == '' or stem == '' or extension not in _TS_FILE_EXTENSIONS:
+                        continue
+                    # ハードリンクやシンボリックリンクで複数のパスから見えている同一ファイルは最初の1回だけ返す
+                    ## シンボリックリンクはリンク先の実体の inode で判定する必要があるため、ここではシンボリックリンクを辿って stat() する
+                    ## stat() の結果は DirEntry 側にキャッシュされるため、システムコールはエントリごとに最大1回で済む
+                    stat_result = entry.stat()
+                    inode_key = (stat_result.st_dev, stat_result.st_ino)
+                    if inode_key in seen_inodes:
+                        continue
+                    seen_inodes.add(inode_key)
+                    # Path オブジェクトの生成コストを避けるため、パスは文字列のまま返す
+                    yield entry.path
+        except OSError:
+            # 走査中にディレクトリが削除された・アクセス権がないなどの場合はスキップする
+            continue
+
+
 class RecordedVideo(TortoiseModel):
 
     # データベース上のテーブル名
@@ -44,6 +116,10 @@ class RecordedVideo(TortoiseModel):
     file_path = fields.TextField()
     file_hash = fields.TextField()
     file_size = fields.IntField()
+    # 録画ファイルの最終更新日時 (UNIX タイムスタンプ)
+    ## (file_size, file_mtime) がファイルシステムの値と一致する場合は内容が変化していないとみなし、再スキャン時のハッシュ計算を省略する
+    ## 0 はマイグレーション前の既存レコードを表し、次回スキャン時にハッシュ計算を経て補完される
+    file_mtime = fields.FloatField(default=0)
     recording_start_time = cast(TortoiseField[datetime | None], fields.DatetimeField(null=True))
     recording_end_time = cast(TortoiseField[datetime | None], fields.DatetimeField(null=True))
     duration = fields.FloatField()
@@ -62,15 +138,16 @@ class RecordedVideo(TortoiseModel):
     secondary_audio_codec = cast(TortoiseField[Literal['AAC-LC'] | None], fields.CharField(255, null=True))
     secondary_audio_channel = cast(TortoiseField[Literal['Monaural', 'Stereo', '5.1ch'] | None], fields.CharField(255, null=True))
     secondary_audio_sampling_rate = cast(TortoiseField[int | None], fields.IntField(null=True))
+    # default を list にすることで、インスタンス生成のたびに共有のリストリテラルが複製されるのを避けている
     cm_sections = cast(TortoiseField[list[CMSection]],
-        fields.JSONField(default=[], encoder=lambda x: json.dumps(x, ensure_ascii=False)))  # type: ignore
+        fields.JSONField(default=list, encoder=_EncodeJSON, decoder=_DecodeJSON))  # type: ignore
 
 
     @classmethod
     async def update(cls) -> None:
         """
         録画ファイルのメタデータを更新する
-        ProcessPoolExecutor を使い、複数のディレクトリを並列に処理する
+        複数のディレクトリを非同期タスクとして並行に処理する
         """
 
         timestamp = time.time()
@@ -87,253 +164,262 @@ class RecordedVideo(TortoiseModel):
             await RecordedProgram.all().delete()
             return
 
-        # 動作中のイベントループを取得
-        loop = asyncio.get_running_loop()
-
-        # 複数のディレクトリを ProcessPoolExecutor で並列に処理する
-        ## with 文で括ることで、with 文を抜けたときに Executor がクリーンアップされるようにする
-        ## さもなければプロセスが残り続けてゾンビプロセス化し、メモリリークを引き起こしてしまう
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            tasks = [loop.run_in_executor(executor, cls.updateDirectoryForMultiProcess, directory) for directory in recorded_folders]
-            tasks = await asyncio.gather(*tasks)
-
-        # スキャンで見つかったすべての録画ファイルのフルパスのリストを取得
-        ## このリストに含まれる録画ファイルは基本すべて DB に保存されているはず (エラーが発生する録画ファイルを除く)
-        existing_files: list[str] = []
-        for task in tasks:
-            existing_files.extend(task)
-
-        # トランザクション配下に入れることでパフォーマンスが向上する
-        async with transactions.in_transaction():
-            # スキャン結果に含まれない録画ファイルが DB に存在する場合は削除する
-            ## RecordedProgram に紐づく RecordedVideo も CASCADE 制約で同時に削除される
-            ## Channel (is_watchable=False) は他の録画ファイルから参照されている可能性があるため、削除されない
-            for recorded_video in await RecordedVideo.all().select_related('recorded_program'):
-                if recorded_video.file_path not in existing_files:
-                    await recorded_video.recorded_program.delete()
-                    logging.info(f'Delete Recorded: {Path(recorded_video.file_path).name}')
+        # 複数のディレクトリを非同期タスクとして並行に処理する
+        ## 処理の大半はファイル I/O と SQLite へのアクセスで占められるため、マルチプロセスにするまでもなく
+        ## 同一イベントループ上のタスクとして並行実行した方が速い
+        ## ProcessPoolExecutor を使っていた頃はワーカープロセスごとに Tortoise ORM の再初期化が必要だったが、
+        ## インプロセス実行なら FastAPI 側で初期化済みの共有コネクションをそのまま使える
+        results = await asyncio.gather(*(cls.updateDirectory(directory) for directory in recorded_folders))
+
+        # スキャンで見つかったすべての録画ファイルのフルパスの集合を取得
+        ## この集合に含まれる録画ファイルは基本すべて DB に保存されているはず (エラーが発生する録画ファイルを除く)
+        ## 削除フェーズでレコードごとに存在チェックを行うため、O(1) で照合できる set にしている
+        existing_files: set[str] = set()
+        for result in results:
+            existing_files.update(result)
+
+        # スキャン結果に含まれない録画ファイルが DB に存在する場合は削除する
+        ## RecordedProgram に紐づく RecordedVideo も CASCADE 制約で同時に削除される
+        ## Channel (is_watchable=False) は他の録画ファイルから参照されている可能性があるため、削除されない
+        ## 必要なカラムだけを values() で取得することで、数千件規模でもモデルインスタンスの生成コストを回避できる
+        db_recorded_videos = await RecordedVideo.all().values('file_path', 'recorded_program_id')
+        delete_recorded_program_ids = [
+            db_recorded_video['recorded_program_id'] for db_recorded_video in db_recorded_videos
+            if db_recorded_video['file_path'] not in existing_files
+        ]
+        if len(delete_recorded_program_ids) > 0:
+            await RecordedProgram.filter(id__in=delete_recorded_program_ids).delete()
+            logging.info(f'Delete {len(delete_recorded_program_ids)} Recorded.')
 
         logging.info(f'Recorded videos update complete. ({round(time.time() - timestamp, 3)} sec)')
 
 
     @classmethod
-    async def updateDirectory(cls, directory: Path) -> list[str]:
+    async def updateDirectory(cls, directory: Path) -> set[str]:
         """
         指定されたディレクトリ以下の録画ファイルのメタデータを更新する
-        ProcessPoolExecutor 内で実行されることを想定している
 
         Args:
             directory (Path): 録画ファイルが格納されているディレクトリ
 
         Returns:
-            list[str]: スキャンで見つかったすべての録画ファイルのフルパスのリスト
+            set[str]: スキャンで見つかったすべての録画ファイルのフルパスの集合
         """
 
         # 循環参照を避けるために遅延インポート
         from app.metadata.MetadataAnalyzer import MetadataAnalyzer
 
-        # Tortoise ORM を再初期化する前に、既存のコネクションを破棄
-        ## これをやっておかないとなぜか正常に初期化できず、DB 操作でフリーズする…
-        ## Windows だとこれをやらなくても問題ないが、Linux だと必要 (Tortoise ORM あるいは aiosqlite のマルチプロセス時のバグ？)
-        connections.discard('default')
-
-        # マルチプロセス時は既存のコネクションが使えないため、Tortoise ORM を初期化し直す
-        # ref: https://tortoise-orm.readthedocs.io/en/latest/setup.html
-        await Tortoise.init(config=DATABASE_CONFIG)
+        # ディレクトリのパスの文字列表現 (前方一致検索などで繰り返し使うため、一度だけ変換しておく)
+        directory_str = str(directory)
 
         # 録画ファイルの変更を DB に保存するタスクの引数を格納するリスト
         ## リスト内のタスクはスキャン完了後に一括で実行される
+        ## 1番目の要素は同一のパスを持つ既存の録画ファイルに紐づく RecordedProgram の ID (存在しない場合は None)
         save_args_list: list[tuple[
-            RecordedVideo | None,
+            int | None,
             RecordedVideo,
             RecordedProgram,
             Channel | None,
         ]] = []
 
+        # 指定されたディレクトリ以下の録画ファイルの DB 上のレコードを一括で取得し、ファイルパスをキーにした辞書にしておく
+        ## ファイルごとに get_or_none() を発行すると、ファイル数に比例して SQLite とのラウンドトリップと
+        ## モデルのインスタンス化コストがかさむため、1回のクエリでまとめて取得してからメモリ上で照合する
+        existing_db_recorded_videos: dict[str, dict] = {
+            row['file_path']: row for row in
+            await RecordedVideo.filter(file_path__startswith=directory_str)
+                .values('file_path', 'file_hash', 'file_size', 'file_mtime', 'recorded_program_id')
+        }
+
+        # (file_size, file_mtime) を DB に補完すべき録画ファイルのリスト
+        ## マイグレーション前から DB に存在するレコード (file_mtime=0) がハッシュ一致で内容未変更と確認された場合に入る
+        ## 補完しておくことで、次回以降のスキャンでは stat() の結果だけでハッシュ計算を省略できるようになる
+        stat_backfill_list: list[tuple[str, int, float]] = []
+
+        # メタデータ解析の同時実行数を CPU コア数までに制限するセマフォ
+        ## 解析処理は MediaInfo / ariblib の C 拡張内で GIL を解放するため、スレッドで並列化する意味がある
+        ## 無制限に投入するとメモリ使用量が際限なく増えるため、セマフォで抑制する
+        analysis_semaphore = asyncio.Semaphore(os.cpu_count() or 1)
+
+        async def analyze(file_path: Path) -> tuple[RecordedVideo, RecordedProgram, Channel | None] | None:
+            async with analysis_semaphore:
+                return await asyncio.to_thread(MetadataAnalyzer(file_path).analyze)
+
+        # スキャン中に投入したメタデータ解析タスクを格納するリスト
+        ## (録画ファイルのパス, 既存の RecordedProgram の ID (新規追加の場合は None), 解析タスク) のタプルが入る
+        analysis_tasks: list[tuple[Path, int | None, asyncio.Task]] = []
+
         # 指定されたディレクトリ以下のファイルを再帰的に走査する
-        ## シンボリックリンクにより同一ファイルが複数回スキャンされることを防ぐため、followlinks=False に設定している
-        ## 本来同期関数の os.walk を非同期関数の中で使うのは望ましくないが (イベントループがブロッキングされるため)、
-        ## この関数自体が ProcessPoolExecutor 内でそれぞれ別プロセスで実行されるため問題ない
-        existing_files: list[str] = []
-        try:
-            for dir_path, _, file_names in os.walk(directory, followlinks=False):
-                for file_name in file_names:
+        ## _iter_ts_files() は os.scandir() ベースの走査なので、os.walk() のようにエントリごとに余分な stat() が発生しない
+        ## 同期処理のファイル走査をそのまま実行するとイベントループがブロッキングされるため、スレッド上で実行する
+        existing_files: set[str] = set()
 
-                    # 録画ファイルのフルパス
-                    file_path = Path(dir_path) / file_name
+        # スキャン結果の件数カウンター (ディレクトリごとのサマリーログ用)
+        ## 大規模ライブラリの初回取り込みではファイルごとのログ出力自体がスキャン処理の大きなコストになるため、
+        ## ファイル単位のログは DEBUG レベルに下げ、INFO レベルではサマリーのみを出力する
+        added_count = 0
+        updated_count = 0
+        skipped_count = 0
 
-                    # 録画ファイルが確実に存在することを確認する (環境次第で稀に os.walk で見つかるファイルが既に存在しなくなっているケースがある)
-                    if file_path.is_file() is False:
-                        continue
+        try:
+            for file_path_str in await asyncio.to_thread(lambda: list(_iter_ts_files(directory))):
 
-                    # バリデーション
-                    ## ._ から始まるファイルは Mac が勝手に作成するファイルなので無視する
-                    if file_path.name.startswith('._'):
-                        continue
-                    ## 当面 TS ファイルのみを対象とする
-                    if file_path.suffix not in ['.ts', '.m2t', '.m2ts', '.mts']:
-                        continue
-                    ## 最終更新日時が 30 秒以内 (=現在録画中) のファイルを無視する
-                    ## 録画中のファイルはメタデータの解析に失敗したり、不正確なメタデータが取得される可能性があるため
-                    if (time.time() - file_path.stat().st_mtime) < 30:
-                        logging.warning(f'{file_path}: File is being recorded. ignored.')
+                ## 最終更新日時が 30 秒以内 (=現在録画中) のファイルを無視する
+                ## 録画中のファイルはメタデータの解析に失敗したり、不正確なメタデータが取得される可能性があるため
+                ## 環境次第で稀にスキャンで見つかったファイルが既に存在しなくなっているケースがあるため、その場合もスキップする
+                try:
+                    stat_result = os.stat(file_path_str)
+                    if (time.time() - stat_result.st_mtime) < 30:
+                        logging.warning(f'{file_path_str}: File is being recorded. ignored.')
                         continue
-
-                    existing_files.append(str(file_path))
-
-                    # 録画ファイルのハッシュを取得
-                    ## 高速化のためにあえて asyncio.to_thread() を使っていない
-                    ## イベントループは ProcessPoolExecutor 内で実行されているため、他の非同期タスクをブロッキングすることはない
-                    try:
-                        file_hash = MetadataAnalyzer(file_path).calculateTSFileHash()
-                    except ValueError:
-                        logging.warning(f'{file_path}: File size is too small. ignored.')
+                except OSError:
+                    continue
+
+                existing_files.add(file_path_str)
+
+                # 同一のパスを持つ録画ファイルが DB に存在するか確認する
+                current_recorded_video = existing_db_recorded_videos.get(file_path_str)
+
+                # (file_size, file_mtime) が DB の値と完全に一致する場合、ファイル内容は変化していないとみなし、
+                # ハッシュ計算もメタデータ解析も行わずにスキップする
+                ## 録画ファイルは基本追記されるか放置されるかのどちらかなので、サイズと最終更新日時の一致で内容の同一性を判定できる
+                ## file_mtime=0 はマイグレーション前の既存レコードなので、一度だけハッシュ計算による検証にフォールバックする
+                if (current_recorded_video is not None and
+                    current_recorded_video['file_mtime'] > 0 and
+                    current_recorded_video['file_size'] == stat_result.st_size and
+                    current_recorded_video['file_mtime'] == stat_result.st_mtime):
+                    skipped_count += 1
+                    continue
+
+                # 録画ファイルのフルパス
+                ## スキャンしたファイルの大半はハッシュ計算時までパスの文字列しか使わないため、ここまで Path 化を遅延させている
+                file_path = Path(file_path_str)
+
+                # 録画ファイルのハッシュを取得
+                ## ファイル I/O でイベントループをブロッキングしないよう、スレッド上で実行する
+                try:
+                    file_hash = await asyncio.to_thread(MetadataAnalyzer(file_path).calculateTSFileHash)
+                except ValueError:
+                    logging.warning(f'{file_path}: File size is too small. ignored.')
+                    continue
+
+                # 同一のパスを持つ録画ファイルが存在しないか、ハッシュが異なる場合はメタデータを取得する
+                if current_recorded_video is None or current_recorded_video['file_hash'] != file_hash:
+
+                    # TODO: CMSectionDetector とシリーズタイトル・話数・サブタイトルの取得処理を並列化する
+                    # どちらも MetadataAnalyzer だけで完結する処理と比較して時間がかかる想定なので、処理の完了を待つべきではない
+
+                    # MetadataAnalyzer によるメタデータの解析をタスクとして投入する
+                    ## 解析は1ファイルあたり数秒かかることもある重い処理なので、スキャンと並行して複数ファイルを同時に解析する
+                    ## タスクの結果はスキャン完了後にまとめて回収する
+                    analysis_tasks.append((
+                        file_path,
+                        current_recorded_video['recorded_program_id'] if current_recorded_video is not None else None,
+                        asyncio.create_task(analyze(file_path)),
+                    ))
+                else:
+                    # ハッシュは一致したが (file_size, file_mtime) が DB 上の値と一致しなかった場合
+                    ## stat() の結果を DB に補完し、次回以降のスキャンでハッシュ計算を省略できるようにする
+                    stat_backfill_list.append((file_path_str, stat_result.st_size, stat_result.st_mtime))
+                    skipped_count += 1
+                    logging.debug(f'Skip Recorded: {file_path.name}')
+
+            # 投入したメタデータ解析タスクの完了を待ち、DB に保存するタスクの引数を組み立てる
+            ## メタデータの解析に失敗した (KonomiTV で再生できない形式など) 場合は None が返るのでスキップする
+            ## Channel モデルは録画ファイルから番組情報を取得できなかった場合は None になる
+            for file_path, current_recorded_program_id, analysis_task in analysis_tasks:
+                try:
+                    result = await analysis_task
+                    if result is None:
+                        # メタデータの解析に失敗するファイルが出ることは一定数想定されうるので warning 扱い
+                        logging.warning(f'{file_path}: Failed to analyze metadata. ignored.')
                         continue
-
-                    # 同一のパスを持つ録画ファイルが DB に存在するか確認する
-                    current_recorded_video = await RecordedVideo.get_or_none(file_path=str(file_path)).select_related('recorded_program')
-
-                    # 同一のパスを持つ録画ファイルが存在しないか、ハッシュが異なる場合はメタデータを取得する
-                    if current_recorded_video is None or current_recorded_video.file_hash != file_hash:
-
-                        # TODO: CMSectionDetector とシリーズタイトル・話数・サブタイトルの取得処理を並列化する
-                        # どちらも MetadataAnalyzer だけで完結する処理と比較して時間がかかる想定なので、処理の完了を待つべきではない
-
-                        # MetadataAnalyzer でメタデータを解析し、RecordedVideo, RecordedProgram, Channel (is_watchable=False) モデルを取得する
-                        ## メタデータの解析に失敗した (KonomiTV で再生できない形式など) 場合は None が返るのでスキップする
-                        ## Channel モデルは録画ファイルから番組情報を取得できなかった場合は None になる
-                        ## asyncio.to_thread() で非同期に実行しないと内部で DB アクセスしている箇所でエラーが発生する
-                        try:
-                            result = await asyncio.to_thread(MetadataAnalyzer(file_path).analyze)
-                            if result is None:
-                                # メタデータの解析に失敗するファイルが出ることは一定数想定されうるので warning 扱い
-                                logging.warning(f'{file_path}: Failed to analyze metadata. ignored.')
-                                continue
-                            recorded_video, recorded_program, channel = result
-                        except Exception:
-                            # メタデータの解析中に予期せぬエラーが発生した場合
-                            # ログ出力した上でスキップする
-                            logging.error(f'{file_path}: Unexpected error occurred while analyzing metadata. ignored.')
-                            logging.error(traceback.format_exc())
-                            continue
-
-                        # メタデータの解析に成功したなら DB に保存するタスクの引数を追加する
-                        # 録画ファイルのスキャン完了後に引数を表すタプルが save() の引数に渡され、一括で DB に保存される
-                        ## スキャン中に DB への書き込みを行うと並列処理の関係でデータベースロックエラーが発生することがあるほか、
-                        ## スキャン用ループのパフォーマンス低下につながるため、敢えて遅延させている
-                        ## 以前は Coroutine を直接追加していたが、Coroutine は一度実行するとエラーが起きても再利用できないため、この実装に変更した
-                        save_args_list.append((current_recorded_video, recorded_video, recorded_program, channel))
-
-                        if current_recorded_video is None:
-                            logging.info(f'Add Recorded: {file_path.name}')
-                        else:
-                            logging.info(f'Update Recorded: {file_path.name}')
-                    else:
-                        #logging.debug(f'Skip Recorded: {file_path.name}')
-                        pass
-
-            async def save(
-                current_recorded_video: RecordedVideo | None,
-                recorded_video: RecordedVideo,
-                recorded_program: RecordedProgram,
-                channel: Channel | None,
-            ) -> None:
-                """
-                録画ファイルの変更を DB に保存する
-                スキャン時にこの関数に渡す引数を作成した後、スキャン終了後に一括で実行する
-                """
-
-                # TODO: 完成形ではこの時点で recorded_program 内にシリーズタイトル・話数・サブタイトルが取得できているはずだが、
-                # Series と SeriesBroadcastPeriod モデル自体は作成および紐付けされていないので、別途それを行う必要がある
-                ## もちろんすべて（あるいはいずれか）が取得できない場合もあるので、取得できる限られた情報から判断するように実装する必要がある
-
-                # 既に同一の ID を持つ Channel が存在する場合は、既存の Channel を使う
-                if channel is not None:
-                    exists_channel = await Channel.get_or_none(id=channel.id)
-                    if exists_channel is not None:
-                        channel = exists_channel
-
-                # 同一のパスを持つ録画ファイルが存在するがハッシュが異なる場合、一旦削除する
-                ## この処理が実行されている時点で、同一のパスを持つ録画ファイルが存在する場合、ハッシュが異なることが確定している
-                ## RecordedProgram に紐づく RecordedVideo も CASCADE 制約で同時に削除される
-                ## Channel (is_watchable=False) は他の録画ファイルから参照されている可能性があるため、削除されない
-                if current_recorded_video is not None:
-                    await current_recorded_video.recorded_program.delete()
-
-                # メタデータの解析に成功したなら DB に保存する
-                ## 子テーブルを保存した後、それらを親テーブルに紐付けて保存する
+                    recorded_video, recorded_program, channel = result
+                except Exception:
+                    # メタデータの解析中に予期せぬエラーが発生した場合
+                    # ログ出力した上でスキップする
+                    logging.error(f'{file_path}: Unexpected error occurred while analyzing metadata. ignored.')
+                    logging.error(traceback.format_exc())
+                    continue
+
+                # チャンネル番号の枝番を確定させる
+                ## 枝番の算出には DB アクセスが必要なため、解析スレッド内では暫定チャンネル番号のみが設定されている
+                ## 共有 DB コネクションはメインのイベントループに紐づいており、スレッド内から安全にアクセスできない
                 if channel is not None:
-                    await channel.save()
-                    recorded_program.channel_id = channel.id
-                await recorded_program.save()
-                recorded_video.recorded_program_id = recorded_program.id
-                await recorded_video.save()
-
-            retry_count = 10
-            while retry_count > 0:
-                try:
-                    # トランザクション配下に入れることでパフォーマンスが向上する
-                    async with transactions.in_transaction():
-
-                        # DB に保存するタスクを一括実行する
-                        ## DB 書き込みは並行だとパフォーマンスが出ないので、普通に for ループで実行する
-                        for save_args in save_args_list:
-                            await save(*save_args)
-
-                        # 正常に DB に保存できたならループを抜ける
-                        break
-
-                # DB が他のプロセスによってロックされている場合は、少し待ってからリトライする
-                ## SQLite は複数プロセスから同時に書き込むことができないため、リトライ処理が必要
-                except exceptions.OperationalError as ex:
-                    if 'database is locked' in str(ex).lower():
-                        retry_count -= 1
-                        logging.warning(f'Failed to save to database. Retrying... ({retry_count}/10)')
-                        await asyncio.sleep(0.25)
-                    else:
-                        # 予期せぬ OperationalError が発生した場合はリトライせずに例外を投げる
-                        raise ex
-
-            if 0 < retry_count < 10:
-                logging.info(f'Succeeded to save to database after retrying.')
-            elif retry_count == 0:
-                logging.error(f'Failed to save to database after retrying. ignored.')
-
-        # 明示的に例外を拾わないとなぜかメインプロセスも含め全体がフリーズしてしまう
+                    channel.channel_number = await channel.calculateChannelNumber()
+                    channel.display_channel_id = channel.type.lower() + channel.channel_number
+
+                # メタデータの解析に成功したなら DB に保存するタスクの引数を追加する
+                ## スキャン中に DB への書き込みを行うと並列処理の関係でデータベースロックエラーが発生することがあるほか、
+                ## スキャン用ループのパフォーマンス低下につながるため、敢えて遅延させている
+                save_args_list.append((current_recorded_program_id, recorded_video, recorded_program, channel))
+
+                if current_recorded_program_id is None:
+                    added_count += 1
+                    logging.debug(f'Add Recorded: {file_path.name}')
+                else:
+                    updated_count += 1
+                    logging.debug(f'Update Recorded: {file_path.name}')
+
+            # TODO: 完成形ではこの時点で recorded_program 内にシリーズタイトル・話数・サブタイトルが取得できているはずだが、
+            # Series と SeriesBroadcastPeriod モデル自体は作成および紐付けされていないので、別途それを行う必要がある
+            ## もちろんすべて（あるいはいずれか）が取得できない場合もあるので、取得できる限られた情報から判断するように実装する必要がある
+
+            # DB がロックされている場合のリトライは SQLite 側の busy_timeout (接続時の PRAGMA で設定) に任せているため、
+            # 以前のような Python 側での 0.25 秒スリープ付きリトライループは不要
+            try:
+                # トランザクション配下に入れることでパフォーマンスが向上する
+                async with transactions.in_transaction():
+
+                    # 同一のパスを持つ録画ファイルが存在するがハッシュが異なる場合、まとめて削除する
+                    ## この処理が実行されている時点で、同一のパスを持つ録画ファイルが存在する場合、ハッシュが異なることが確定している
+                    ## RecordedProgram に紐づく RecordedVideo も CASCADE 制約で同時に削除される
+                    stale_recorded_program_ids = [args[0] for args in save_args_list if args[0] is not None]
+                    if len(stale_recorded_program_ids) > 0:
+                        await RecordedProgram.filter(id__in=stale_recorded_program_ids).delete()
+
+                    # Channel (is_watchable=False) を一括で保存する
+                    ## 既に同一の ID を持つ Channel が存在する場合は既存の行をそのまま使う (ignore_conflicts=True)
+                    ## Channel は他の録画ファイルから参照されている可能性があるため、削除・更新は行われない
+                    channels = {channel.id: channel for _, _, _, channel in save_args_list if channel is not None}
+                    if len(channels) > 0:
+                        await Channel.bulk_create(list(channels.values()), ignore_conflicts=True)
+
+                    # RecordedProgram を保存した後、採番された ID を紐付けた RecordedVideo を一括で保存する
+                    ## RecordedProgram は AUTOINCREMENT で採番された ID を RecordedVideo に紐付ける必要があるため1件ずつ保存するが、
+                    ## RecordedVideo 自体の ID は他から参照されないため、最後に1回の INSERT でまとめて保存できる
+                    recorded_videos: list[RecordedVideo] = []
+                    for _, recorded_video, recorded_program, channel in save_args_list:
+                        if channel is not None:
+                            recorded_program.channel_id = channel.id
+                        await recorded_program.save()
+                        recorded_video.recorded_program_id = recorded_program.id
+                        recorded_videos.append(recorded_video)
+                    if len(recorded_videos) > 0:
+                        await RecordedVideo.bulk_create(recorded_videos)
+
+                    # 内容未変更と確認された既存レコードに (file_size, file_mtime) を補完する
+                    ## マイグレーション直後の1回だけ発生する処理で、以降のスキャンではレコードごとの UPDATE は発行されない
+                    for backfill_file_path, backfill_file_size, backfill_file_mtime in stat_backfill_list:
+                        await RecordedVideo.filter(file_path=backfill_file_path) \
+                            .update(file_size=backfill_file_size, file_mtime=backfill_file_mtime)
+
+            # busy_timeout を使い果たしても DB のロックが解除されなかった場合
+            except exceptions.OperationalError as ex:
+                if 'database is locked' in str(ex).lower():
+                    logging.error(f'Failed to save to database. (database is locked) ignored.')
+                else:
+                    # 予期せぬ OperationalError が発生した場合は例外を投げる
+                    raise ex
+
+            # ディレクトリごとのスキャン結果のサマリーを出力する
+            logging.info(f'{directory}: Added: {added_count} / Updated: {updated_count} / Skipped: {skipped_count}')
+
+        # 予期せぬ例外が発生した場合は、ログ出力した上でスキャン済みのファイルリストだけを返す
         except Exception:
             logging.error(traceback.format_exc())
 
-        # 開いた Tortoise ORM のコネクションを明示的に閉じる
-        # コネクションを閉じないと Ctrl+C を押下しても終了できない
-        finally:
-            await Tortoise.close_connections()
-
         # 強制的にガベージコレクションを実行する
         gc.collect()
 
         return existing_files
-
-
-    @classmethod
-    def updateDirectoryForMultiProcess(cls, directory: Path) -> list[str]:
-        """
-        RecordedVideo.updateDirectory() の同期版 (ProcessPoolExecutor でのマルチプロセス実行用)
-
-        Args:
-            directory (Path): 録画ファイルが格納されているディレクトリ
-
-        Returns:
-            list[str]: スキャンで見つかったすべての録画ファイルのフルパスのリスト
-        """
-
-        # もし Config() の実行時に AssertionError が発生した場合は、LoadConfig() を実行してサーバー設定データをロードする
-        ## 通常ならマルチプロセス実行時もサーバー設定データがロードされているはずだが、
-        ## 自動リロードモード時のみなぜかグローバル変数がマルチプロセスに引き継がれないため、明示的にロードさせる必要がある
-        try:
-            Config()
-        except AssertionError:
-            # バリデーションは既にサーバー起動時に行われているためスキップする
-            LoadConfig(bypass_validation=True)
-
-        # asyncio.run() で非同期メソッドの実行が終わるまで待つ
-        return asyncio.run(cls.updateDirectory(directory))
@@ -12,6 +12,7 @@ import os
 import re
 import sys
 import time
+from collections import deque
 from aiofiles.threadpool.text import AsyncTextIOWrapper
 from biim.mpeg2ts import ts
 from typing import AsyncIterator, cast, ClassVar, Literal, TYPE_CHECKING
@@ -47,6 +48,11 @@ class LiveEncodingTask:
     ENCODER_TS_READ_TIMEOUT_ONAIR: ClassVar[int] = 5
     ENCODER_TS_READ_TIMEOUT_ONAIR_VCEENCC: ClassVar[int] = 10
 
+    # 組み立て済みのエンコーダーオプションのキャッシュ
+    ## オプションの内容は品質・チャンネル種別・リトライ回数の組み合わせで一意に決まるため、
+    ## ストリーム開始のたびに文字列のフォーマットと分割をやり直す必要はない
+    __encoder_options_cache: ClassVar[dict[tuple, list[str]]] = {}
+
 
     def __init__(self, live_stream: LiveStream) -> None:
         """
@@ -114,6 +120,15 @@ class LiveEncodingTask:
             list[str]: FFmpeg に渡すオプションが連なる配列
         """
 
+        # 同じ組み合わせで組み立て済みのオプションがあれば、それを使い回す
+        cache_key = ('FFmpeg', quality, is_fullhd_channel, is_sphd_channel, self._retry_count)
+        if cache_key in self.__encoder_options_cache:
+            return self.__encoder_options_cache[cache_key].copy()
+
+        # 指定された品質の設定データ
+        ## 以降何度も参照するため、ローカル変数に入れて辞書の参照回数を減らす
+        quality_config = QUALITY[quality]
+
         # オプションの入る配列
         options: list[str] = []
 
@@ -141,35 +156,35 @@ class LiveEncodingTask:
 
         # 映像
         ## コーデック
-        if QUALITY[quality].is_hevc is True:
+        if quality_config.is_hevc is True:
             options.append('-vcodec libx265')  # H.265/HEVC (通信節約モード)
         else:
             options.append('-vcodec libx264')  # H.264
 
         ## ビットレートと品質
-        options.append(f'-flags +cgop -vb {QUALITY[quality].video_bitrate} -maxrate {QUALITY[quality].video_bitrate_max}')
+        options.append(f'-flags +cgop -vb {quality_config.video_bitrate} -maxrate {quality_config.video_bitrate_max}')
         options.append('-preset veryfast -aspect 16:9')
-        if QUALITY[quality].is_hevc is True:
+        if quality_config.is_hevc is True:
             options.append('-profile:v main')
         else:
             options.append('-profile:v high')
 
         ## フル HD 放送が行われているチャンネルかつ、指定された品質の解像度が 1440×1080 (1080p) の場合のみ、
         ## 特別に縦解像度を 1920 に変更してフル HD (1920×1080) でエンコードする
-        video_width = QUALITY[quality].width
-        video_height = QUALITY[quality].height
+        video_width = quality_config.width
+        video_height = quality_config.height
         if video_width == 1440 and video_height == 1080 and is_fullhd_channel is True:
             video_width = 1920
 
         ## 最大 GOP 長 (秒)
         ## 30fps なら ×30 、 60fps なら ×60 された値が --gop-len で使われる
         gop_length_second = self.GOP_LENGTH_SECONDS_H264
-        if QUALITY[quality].is_hevc is True:
+        if quality_config.is_hevc is True:
             ## H.265/HEVC では高圧縮化のため、最大 GOP 長を長くする
             gop_length_second = self.GOP_LENGTH_SECONDS_H265
 
         ## インターレース解除 (60i → 60p (フレームレート: 60fps))
-        if QUALITY[quality].is_60fps is True:
+        if quality_config.is_60fps is True:
             options.append(f'-vf yadif=mode=1:parity=-1:deint=1,scale={video_width}:{video_height}')
             options.append(f'-r 60000/1001 -g {int(gop_length_second * 60)}')
         ## インターレース解除 (60i → 30p (フレームレート: 30fps))
@@ -179,18 +194,17 @@ class LiveEncodingTask:
 
         # 音声
         ## 音声が 5.1ch かどうかに関わらず、ステレオにダウンミックスする
-        options.append(f'-acodec aac -aac_coder twoloop -ac 2 -ab {QUALITY[quality].audio_bitrate} -ar 48000 -af volume=2.0')
+        options.append(f'-acodec aac -aac_coder twoloop -ac 2 -ab {quality_config.audio_bitrate} -ar 48000 -af volume=2.0')
 
         # 出力
         options.append('-y -f mpegts')  # MPEG-TS 出力ということを明示
         options.append('pipe:1')  # 標準入力へ出力
 
-        # オプションをスペースで区切って配列にする
-        result: list[str] = []
-        for option in options:
-            result += option.split(' ')
+        # オプションをスペースで区切って配列にし、次回以降のためにキャッシュする
+        result: list[str] = ' '.join(options).split(' ')
+        self.__encoder_options_cache[cache_key] = result
 
-        return result
+        return result.copy()
 
 
     def buildFFmpegOptionsForRadio(self) -> list[str]:
@@ -203,6 +217,11 @@ class LiveEncodingTask:
             list[str]: FFmpeg に渡すオプションが連なる配列
         """
 
+        # 同じ組み合わせで組み立て済みのオプションがあれば、それを使い回す
+        cache_key = ('FFmpegRadio', self._retry_count)
+        if cache_key in self.__encoder_options_cache:
+            return self.__encoder_options_cache[cache_key].copy()
+
         # オプションの入る配列
         options: list[str] = []
 
@@ -230,12 +249,11 @@ class LiveEncodingTask:
         options.append('-y -f mpegts')  # MPEG-TS 出力ということを明示
         options.append('pipe:1')  # 標準入力へ出力
 
-        # オプションをスペースで区切って配列にする
-        result: list[str] = []
-        for option in options:
-            result += option.split(' ')
+        # オプションをスペースで区切って配列にし、次回以降のためにキャッシュする
+        result: list[str] = ' '.join(options).split(' ')
+        self.__encoder_options_cache[cache_key] = result
 
-        return result
+        return result.copy()
 
 
     def buildHWEncCOptions(self,
@@ -257,6 +275,15 @@ class LiveEncodingTask:
             list[str]: HWEncC に渡すオプションが連なる配列
         """
 
+        # 同じ組み合わせで組み立て済みのオプションがあれば、それを使い回す
+        cache_key = (encoder_type, quality, is_fullhd_channel, is_sphd_channel, self._retry_count)
+        if cache_key in self.__encoder_options_cache:
+            return self.__encoder_options_cache[cache_key].copy()
+
+        # 指定された品質の設定データ
+        ## 以降何度も参照するため、ローカル変数に入れて辞書の参照回数を減らす
+        quality_config = QUALITY[quality]
+
         # オプションの入る配列
         options: list[str] = []
 
@@ -303,7 +330,7 @@ class LiveEncodingTask:
 
         # 映像
         ## コーデック
-        if QUALITY[quality].is_hevc is True:
+        if quality_config.is_hevc is True:
             options.append('--codec hevc')  # H.265/HEVC (通信節約モード)
         else:
             options.append('--codec h264')  # H.264
@@ -311,14 +338,14 @@ class LiveEncodingTask:
         ## ビットレート
         ## H.265/HEVC かつ QSVEncC の場合のみ、--qvbr (品質ベース可変ビットレート) モードでエンコードする
         ## それ以外は --vbr (可変ビットレート) モードでエンコードする
-        if QUALITY[quality].is_hevc is True and encoder_type == 'QSVEncC':
-            options.append(f'--qvbr {QUALITY[quality].video_bitrate} --fallback-rc')
+        if quality_config.is_hevc is True and encoder_type == 'QSVEncC':
+            options.append(f'--qvbr {quality_config.video_bitrate} --fallback-rc')
         else:
-            options.append(f'--vbr {QUALITY[quality].video_bitrate}')
-        options.append(f'--max-bitrate {QUALITY[quality].video_bitrate_max}')
+            options.append(f'--vbr {quality_config.video_bitrate}')
+        options.append(f'--max-bitrate {quality_config.video_bitrate_max}')
 
         ## H.265/HEVC の高圧縮化調整
-        if QUALITY[quality].is_hevc is True:
+        if quality_config.is_hevc is True:
             if encoder_type == 'QSVEncC':
                 options.append('--qvbr-quality 30')
             elif encoder_type == 'NVEncC':
@@ -338,7 +365,7 @@ class LiveEncodingTask:
             options.append('--preset balanced')
         elif encoder_type == 'rkmppenc':
             options.append('--preset best')
-        if QUALITY[quality].is_hevc is True:
+        if quality_config.is_hevc is True:
             options.append('--profile main')
         else:
             options.append('--profile high')
@@ -347,7 +374,7 @@ class LiveEncodingTask:
         ## 最大 GOP 長 (秒)
         ## 30fps なら ×30 、 60fps なら ×60 された値が --gop-len で使われる
         gop_length_second = self.GOP_LENGTH_SECONDS_H264
-        if QUALITY[quality].is_hevc is True:
+        if quality_config.is_hevc is True:
             ## H.265/HEVC では高圧縮化のため、最大 GOP 長を長くする
             gop_length_second = self.GOP_LENGTH_SECONDS_H265
 
@@ -355,7 +382,7 @@ class LiveEncodingTask:
         ## NVEncC の --vpp-deinterlace bob は品質が悪いので、代わりに --vpp-yadif を使う
         ## NVIDIA GPU は当然ながら Intel の内蔵 GPU よりも性能が高いので、GPU フィルタを使ってもパフォーマンスに問題はないと判断
         ## VCEEncC では --vpp-deinterlace 自体が使えないので、代わりに --vpp-yadif を使う
-        if QUALITY[quality].is_60fps is True:
+        if quality_config.is_60fps is True:
             if encoder_type == 'QSVEncC':
                 options.append('--vpp-deinterlace bob')
             elif encoder_type == 'NVEncC' or encoder_type == 'VCEEncC':
@@ -378,26 +405,25 @@ class LiveEncodingTask:
 
         ## フル HD 放送が行われているチャンネルかつ、指定された品質の解像度が 1440×1080 (1080p) の場合のみ、
         ## 特別に縦解像度を 1920 に変更してフル HD (1920×1080) でエンコードする
-        video_width = QUALITY[quality].width
-        video_height = QUALITY[quality].height
+        video_width = quality_config.width
+        video_height = quality_config.height
         if video_width == 1440 and video_height == 1080 and is_fullhd_channel is True:
             video_width = 1920
         options.append(f'--output-res {video_width}x{video_height}')
 
         # 音声
-        options.append(f'--audio-codec aac:aac_coder=twoloop --audio-bitrate {QUALITY[quality].audio_bitrate}')
+        options.append(f'--audio-codec aac:aac_coder=twoloop --audio-bitrate {quality_config.audio_bitrate}')
         options.append('--audio-samplerate 48000 --audio-filter volume=2.0 --audio-ignore-decode-error 30')
 
         # 出力
         options.append('--output-format mpegts')  # MPEG-TS 出力ということを明示
         options.append('--output -')  # 標準入力へ出力
 
-        # オプションをスペースで区切って配列にする
-        result: list[str] = []
-        for option in options:
-            result += option.split(' ')
+        # オプションをスペースで区切って配列にし、次回以降のためにキャッシュする
+        result: list[str] = ' '.join(options).split(' ')
+        self.__encoder_options_cache[cache_key] = result
 
-        return result
+        return result.copy()
 
 
     async def acquireMirakurunTuner(self, channel_type: Literal['GR', 'BS', 'CS', 'CATV', 'SKY', 'STARDIGIO']) -> bool:
@@ -542,17 +568,6 @@ class LiveEncodingTask:
         # tsreadex の読み込み用パイプと書き込み用パイプを作成
         tsreadex_read_pipe, tsreadex_write_pipe = os.pipe()
 
-        # tsreadex のプロセスを非同期で作成・実行
-        tsreadex = await asyncio.subprocess.create_subprocess_exec(
-            *[LIBRARY_PATH['tsreadex'], *tsreadex_options],
-            stdin = asyncio.subprocess.PIPE,  # 受信した放送波を書き込む
-            stdout = tsreadex_write_pipe,  # エンコーダーに繋ぐ
-            stderr = asyncio.subprocess.DEVNULL,  # 利用しない
-        )
-
-        # tsreadex の書き込み用パイプを閉じる
-        os.close(tsreadex_write_pipe)
-
         # ***** エンコーダープロセスの作成と実行 *****
 
         # エンコーダーの起動には時間がかかるので、先にエンコーダーを起動しておいた後、あとからチューナーを起動する
@@ -576,14 +591,7 @@ class LiveEncodingTask:
             else:
                 encoder_options = self.buildFFmpegOptions(self.live_stream.quality, is_fullhd_channel, channel.type == 'SKY')
             logging.info(f'[Live: {self.live_stream.live_stream_id}] FFmpeg Commands:\nffmpeg {" ".join(encoder_options)}')
-
-            # エンコーダープロセスを非同期で作成・実行
-            encoder = await asyncio.subprocess.create_subprocess_exec(
-                *[LIBRARY_PATH['FFmpeg'], *encoder_options],
-                stdin = tsreadex_read_pipe,  # tsreadex からの入力
-                stdout = asyncio.subprocess.PIPE,  # ストリーム出力
-                stderr = asyncio.subprocess.PIPE,  # ログ出力
-            )
+            encoder_path = LIBRARY_PATH['FFmpeg']
 
         # HWEncC
         else:
@@ -591,16 +599,28 @@ class LiveEncodingTask:
             # オプションを取得
             encoder_options = self.buildHWEncCOptions(self.live_stream.quality, ENCODER_TYPE, is_fullhd_channel, channel.type == 'SKY')
             logging.info(f'[Live: {self.live_stream.live_stream_id}] {ENCODER_TYPE} Commands:\n{ENCODER_TYPE} {" ".join(encoder_options)}')
-
-            # エンコーダープロセスを非同期で作成・実行
-            encoder = await asyncio.subprocess.create_subprocess_exec(
-                *[LIBRARY_PATH[ENCODER_TYPE], *encoder_options],
+            encoder_path = LIBRARY_PATH[ENCODER_TYPE]
+
+        # tsreadex とエンコーダーのプロセスを非同期で並行に作成・実行
+        ## プロセスの起動 (特に Windows の CreateProcess) はそれなりに時間がかかるため、
+        ## 2つのプロセスを並行に起動することでチャンネル切り替え時のレイテンシを削減する
+        tsreadex, encoder = await asyncio.gather(
+            asyncio.subprocess.create_subprocess_exec(
+                *[LIBRARY_PATH['tsreadex'], *tsreadex_options],
+                stdin = asyncio.subprocess.PIPE,  # 受信した放送波を書き込む
+                stdout = tsreadex_write_pipe,  # エンコーダーに繋ぐ
+                stderr = asyncio.subprocess.DEVNULL,  # 利用しない
+            ),
+            asyncio.subprocess.create_subprocess_exec(
+                *[encoder_path, *encoder_options],
                 stdin = tsreadex_read_pipe,  # tsreadex からの入力
                 stdout = asyncio.subprocess.PIPE,  # ストリーム出力
                 stderr = asyncio.subprocess.PIPE,  # ログ出力
-            )
+            ),
+        )
 
-        # tsreadex の読み込み用パイプを閉じる
+        # 子プロセス側に渡し終えたパイプを閉じる
+        os.close(tsreadex_write_pipe)
         os.close(tsreadex_read_pipe)
 
         # ***** チューナーの起動と接続 *****
@@ -923,28 +943,40 @@ class LiveEncodingTask:
             if CONFIG.general.debug_encoder is True:
                 encoder_log = await aiofiles.open(encoder_log_path, mode='w', encoding='utf-8')
 
+            # エンコーダーの出力のうち、まだ行として取り出されていない分を貯めておくバッファ
+            ## FFmpeg はコンソールの行を上書きするために frame= の進捗ログで \r しか出力しないため、readline() を使うと
+            ## 進捗ログを取得できずに永遠に Standby から ONAir に移行しない不具合が発生する
+            ## かといって1バイトずつ読み込むと Python レベルのループが1バイトごとに回って CPU を無駄に消費するため、
+            ## ある程度まとまったチャンクで読み込んでから \r と \n の両方を行区切りとして分割する
+            read_buffer = bytearray()
+            pending_lines: deque[bytes] = deque()
+            is_eof = False
+
             # エンコーダーの出力結果を取得
             while True:
 
-                # 行ごとに随時読み込む
-                ## 1バイトずつ読み込み、\r か \n が来たら行としてデコード
-                ## FFmpeg はコンソールの行を上書きするために frame= の進捗ログで \r しか出力しないため、readline() を使うと
-                ## 進捗ログを取得できずに永遠に Standby から ONAir に移行しない不具合が発生する
-                buffer = bytearray()
-                while True:
-                    byte = await cast(asyncio.StreamReader, encoder.stderr).read(1)
-                    buffer += byte
-                    if byte == b'\r' or byte == b'\n':
-                        break
-                    if byte == b'':
+                # 分割済みの行がなくなったら、新しいチャンクを読み込んで行に分割する
+                while len(pending_lines) == 0:
+                    chunk = await cast(asyncio.StreamReader, encoder.stderr).read(65536)
+                    # 空のデータが返ってきたら、エンコーダーが終了したと判断する
+                    ## 行になりきっていないバッファの残りも最後の行として取り出す
+                    if len(chunk) == 0:
+                        is_eof = True
+                        if len(read_buffer) > 0:
+                            pending_lines.append(bytes(read_buffer))
+                            read_buffer = bytearray()
                         break
+                    read_buffer += chunk
+                    *complete_lines, remainder = re.split(rb'[\r\n]', read_buffer)
+                    pending_lines.extend(complete_lines)
+                    read_buffer = bytearray(remainder)
 
-                # 空のデータが返ってきたら、エンコーダーが終了したと判断してタスクを終了
-                if len(buffer) == 0:
+                # エンコーダーが終了し、かつすべての行を処理し終えたらタスクを終了
+                if is_eof is True and len(pending_lines) == 0:
                     break
 
                 try:
-                    line = buffer.decode('utf-8').strip()
+                    line = pending_lines.popleft().decode('utf-8').strip()
                 except UnicodeDecodeError:
                     continue
 
@@ -1285,7 +1317,9 @@ class LiveEncodingTask:
             # 再起動回数が最大再起動回数に達していなければ、再起動する
             if self._retry_count < self._max_retry_count:
                 self._retry_count += 1  # カウントを増やす
-                await asyncio.sleep(0.1)  # 少し待つ
+                ## 連続でクラッシュしている場合はリトライ間隔を指数的に延ばす (最大2秒)
+                ## 即時再起動を繰り返すとチューナーやエンコーダーの初期化に無駄な負荷がかかるため
+                await asyncio.sleep(min(0.1 * (2 ** self._retry_count), 2.0))
                 asyncio.create_task(self.run())  # 新しいタスクを立ち上げる
 
             # 最大再起動回数を使い果たしたので、Offline にする
@@ -562,7 +562,10 @@ class EDCBUtil:
             for port in range(30):
                 try:
                     path = '\\\\.\\pipe\\SendTSTCP_' + str(port) + '_' + str(process_id)
-                    pipe = await asyncio.to_thread(open, path, mode='rb')
+                    # バッファサイズをデフォルトの 8KB から 1MB に拡大する
+                    ## 放送波 TS はスループットが高いため、大きめのバッファでまとめて読み込んだ方が
+                    ## パイプへの ReadFile 呼び出し回数 (とスレッドプールへのディスパッチ回数) を大幅に減らせる
+                    pipe = await asyncio.to_thread(open, path, mode='rb', buffering=1048576)
                     return PipeStreamReader(pipe, ThreadPoolExecutor())
                 except Exception:
                     pass